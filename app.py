@@ -3,13 +3,23 @@ import sys
 import os
 import json
 import random
+import time
+import threading
+import atexit
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
 from decimal import Decimal 
 import mysql.connector
+from mysql.connector import pooling, errorcode
 from twilio.twiml.messaging_response import MessagingResponse
 from dotenv import load_dotenv
-from flask import Flask, request
+from flask import Flask, request, g
 from datetime import datetime, timedelta
-from calendar import day_name
+from calendar import day_name, day_abbr
+from session_codec import encode_session, decode_session
 
 # -------------------- Configuration & DB Setup -------------------- #
 load_dotenv()
@@ -24,10 +34,27 @@ DB_USER = os.getenv("DB_USER", "root")
 DB_PASSWORD = os.getenv("DB_PASSWORD", "")
 DB_DATABASE = os.getenv("DB_DATABASE", "glow_haven_bot") 
 
+SERVER_THREADS = int(os.getenv("SERVER_THREADS", "8"))  # Concurrent requests the web server handles per process
+# One connection per request thread plus one for the write-buffer flusher (mysql-connector allows at most 32)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", str(min(SERVER_THREADS + 1, pooling.CNX_POOL_MAXSIZE))))
+
 SALON_START_HOUR = 9
 SALON_END_HOUR = 19 
 EXCLUDED_WEEKDAY = 6 
 
+# Multi-branch routing: each branch is looked up by the Twilio number it receives messages on.
+TENANTS_FILE = os.getenv("TENANTS_FILE", "tenants.json")
+TENANT_IDLE_SECONDS = int(os.getenv("TENANT_IDLE_SECONDS", "900"))  # Evict a branch's pool/caches after 15 idle mins
+CATALOG_CACHE_SECONDS = 300  # Service menu rarely changes
+SCHEDULE_CACHE_SECONDS = 30  # Booked slots change often, keep this short
+
+# Write-behind buffer for append-only inserts (feedback etc.)
+WRITE_BUFFER_LOG = os.getenv("WRITE_BUFFER_LOG", "write_buffer.log")  # Each worker process locks its own numbered copy
+WRITE_BUFFER_MAX_LOGS = 64
+WRITE_BUFFER_MAX_ROWS = int(os.getenv("WRITE_BUFFER_MAX_ROWS", "50"))
+WRITE_BUFFER_FLUSH_MS = int(os.getenv("WRITE_BUFFER_FLUSH_MS", "500"))
+WRITE_BUFFER_MAX_RETRY_SECONDS = 30
+
 # BRANDING_IMAGE_URL = "https://images.unsplash.com/photo-1542662562-b9e7634f195d?q=80&w=1974&auto=format&fit=crop&ixlib=rb-4.0.3&ixid=M3wxMjA3fDB8MHxwaG90by1wYWdlfHx8fGVufDB8fHx8fA%3D%3D"
 
 if not TWILIO_ACCOUNT_SID or not TWILIO_AUTH_TOKEN:
@@ -37,42 +64,528 @@ if not TWILIO_ACCOUNT_SID or not TWILIO_AUTH_TOKEN:
 # Initialize Flask
 app = Flask(__name__)
 
+# -------------------- Multi-Branch (Tenant) Setup -------------------- #
+def normalize_number(number):
+    """Strips the 'whatsapp:' prefix and whitespace so numbers can be used as lookup keys."""
+    return (number or "").replace('whatsapp:', '').strip()
+
+def load_tenant_configs():
+    """
+    Loads branch configs from TENANTS_FILE, keyed by Twilio number.
+    Without the file, a single branch is built from the .env settings (the original single-salon setup).
+    Any key a branch leaves out falls back to the single-salon default, except db_database: the sessions
+    and bookings tables have no branch column, so every branch needs its own database.
+    """
+    base_config = {
+        'slug': 'valley-arcade',
+        'name': 'Valley Arcade',
+        'twilio_number': TWILIO_WHATSAPP_NUMBER,
+        'location': '1st Floor, Valley Arcade Mall, Nairobi',
+        'contact': 'Call us at +254 712 345 678 or email info@glowhavenbeauty.co.ke',
+        'instagram': '@glowhavenbeautylounge',
+        'start_hour': SALON_START_HOUR,
+        'end_hour': SALON_END_HOUR,
+        'excluded_weekday': EXCLUDED_WEEKDAY,
+        'db_host': DB_HOST,
+        'db_user': DB_USER,
+        'db_password': DB_PASSWORD,
+        'db_database': DB_DATABASE,
+        'pool_size': DB_POOL_SIZE,
+        'default': False,
+    }
+
+    if not os.path.exists(TENANTS_FILE):
+        base_config['default'] = True
+        return {normalize_number(base_config['twilio_number']): base_config}, base_config
+
+    with open(TENANTS_FILE, encoding='utf-8') as f:
+        branches = json.load(f).get('branches', [])
+
+    configs = {}
+    default_config = None
+    databases = {}
+    for branch in branches:
+        slug = branch.get('slug', '?')
+        if not branch.get('db_database'):
+            print(f"FATAL ERROR: Branch '{slug}' in {TENANTS_FILE} must set its own db_database.")
+            sys.exit(1)
+
+        config = {**base_config, **branch}
+        database = (config['db_host'], config['db_database'])
+        if database in databases:
+            print(f"FATAL ERROR: Branches '{databases[database]}' and '{slug}' share the database "
+                  f"{config['db_database']}@{config['db_host']}. Each branch needs its own database.")
+            sys.exit(1)
+        databases[database] = slug
+
+        # Keep passwords out of the tenants file by naming an env variable instead
+        if config.get('db_password_env'):
+            config['db_password'] = os.getenv(config['db_password_env'], "")
+        configs[normalize_number(config['twilio_number'])] = config
+        if config.get('default'):
+            default_config = config
+
+    return configs, default_config
+
+def get_hours_text(config):
+    """Builds the opening hours line (e.g. 'Mon-Sat, 9:00 AM - 7:00 PM | Sunday: Closed') for a branch."""
+    open_time = datetime(2000, 1, 1, config['start_hour']).strftime('%I:%M %p').lstrip('0')
+    close_time = datetime(2000, 1, 1, config['end_hour']).strftime('%I:%M %p').lstrip('0')
+    excluded = config.get('excluded_weekday')
+
+    if excluded is None:
+        return f"Daily, {open_time} - {close_time}"
+    first_day = day_abbr[(excluded + 1) % 7]
+    last_day = day_abbr[(excluded - 1) % 7]
+    return f"{first_day}-{last_day}, {open_time} - {close_time} | {day_name[excluded]}: Closed"
+
+
+class Tenant:
+    """
+    Per-branch resources: DB connection pool, service catalog cache and booked-slot index.
+    Everything is created on first use so idle branches cost nothing.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.pool = None
+        self.catalog = None
+        self.catalog_loaded_at = 0
+        self.booked_slots = {}  # 'YYYY-MM-DD' -> (loaded_at, set of booked datetimes)
+        self.in_flight = 0
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock()
+
+    def get_connection(self):
+        """
+        Returns a pooled connection, creating the branch's pool on first use.
+        The pool doesn't wait when every connection is checked out, so fall back to a direct connection
+        (closed for real on close()) rather than turning a busy moment into an error.
+        """
+        config = self.config
+        with self.lock:
+            if self.pool is None:
+                self.pool = pooling.MySQLConnectionPool(
+                    pool_name=f"glow_{config['slug']}"[:64],
+                    pool_size=min(config['pool_size'], pooling.CNX_POOL_MAXSIZE),
+                    host=config['db_host'], user=config['db_user'], password=config['db_password'],
+                    database=config['db_database'], autocommit=False
+                )
+            pool = self.pool
+        try:
+            return pool.get_connection()
+        except pooling.PoolError:
+            print(f"DB POOL EXHAUSTED for branch {config['slug']}: opening a direct connection.")
+            return mysql.connector.connect(
+                host=config['db_host'], user=config['db_user'], password=config['db_password'],
+                database=config['db_database'], autocommit=False
+            )
+
+    def get_services(self, cursor):
+        """Returns the branch's service rows, re-reading the table every CATALOG_CACHE_SECONDS."""
+        now = time.monotonic()
+        if self.catalog is None or now - self.catalog_loaded_at > CATALOG_CACHE_SECONDS:
+            cursor.execute("SELECT id, name, price, duration FROM services ORDER BY id ASC")
+            self.catalog = cursor.fetchall()
+            self.catalog_loaded_at = now
+        return self.catalog
+
+    def find_service(self, cursor, service_id):
+        """Looks up a single service by ID from the cached catalog."""
+        for service in self.get_services(cursor):
+            if service['id'] == service_id:
+                return service
+        return None
+
+    def get_booked_times(self, cursor, selected_date):
+        """Returns the set of booked start times for a date with one query, cached for SCHEDULE_CACHE_SECONDS."""
+        date_key = selected_date.strftime('%Y-%m-%d')
+        now = time.monotonic()
+        cached = self.booked_slots.get(date_key)
+        if cached and now - cached[0] <= SCHEDULE_CACHE_SECONDS:
+            return cached[1]
+
+        day_start = selected_date.replace(hour=0, minute=0, second=0, microsecond=0)
+        cursor.execute("""
+            SELECT booking_time FROM bookings
+            WHERE booking_time >= %s AND booking_time < %s
+        """, (day_start.strftime('%Y-%m-%d %H:%M:%S'), (day_start + timedelta(days=1)).strftime('%Y-%m-%d %H:%M:%S')))
+        booked = {row['booking_time'] for row in cursor.fetchall()}
+        self.booked_slots[date_key] = (now, booked)
+        return booked
+
+    def mark_booked(self, booking_time):
+        """Adds a newly inserted booking to the slot index so it is not offered again."""
+        cached = self.booked_slots.get(booking_time.strftime('%Y-%m-%d'))
+        if cached:
+            cached[1].add(booking_time)
+
+    def evict(self):
+        """Drops the pool's idle connections and all cached data."""
+        with self.lock:
+            if self.pool is not None:
+                # MySQLConnectionPool has no public close; this closes every connection sitting in the pool
+                self.pool._remove_connections()
+                self.pool = None
+            self.catalog = None
+            self.booked_slots = {}
+
+
+class TenantRegistry:
+    """Routes a receiving Twilio number to its Tenant and evicts branches that have gone idle."""
+
+    def __init__(self):
+        self.configs, self.default_config = load_tenant_configs()
+        self.active = {}  # twilio number -> Tenant
+        self.last_sweep = time.monotonic()
+        self.lock = threading.Lock()
+
+    def checkout(self, to_number):
+        """Returns the Tenant for a receiving number (or the default branch), or None if unknown."""
+        number = normalize_number(to_number)
+        config = self.configs.get(number) or self.default_config
+        if config is None:
+            return None
+
+        key = normalize_number(config['twilio_number'])
+        with self.lock:
+            self.sweep()
+            tenant = self.active.get(key)
+            if tenant is None:
+                tenant = Tenant(config)
+                self.active[key] = tenant
+            tenant.in_flight += 1
+        return tenant
+
+    def checkin(self, tenant):
+        """Marks a request as finished so the branch can be evicted once idle."""
+        with self.lock:
+            tenant.in_flight -= 1
+            tenant.last_used = time.monotonic()
+
+    def sweep(self):
+        """Evicts branches with no requests in TENANT_IDLE_SECONDS. Called with self.lock held."""
+        now = time.monotonic()
+        if now - self.last_sweep < 60:
+            return
+        self.last_sweep = now
+        for key, tenant in list(self.active.items()):
+            if tenant.in_flight == 0 and now - tenant.last_used > TENANT_IDLE_SECONDS:
+                print(f"TENANT EVICTED: {tenant.config['slug']} idle for {int(now - tenant.last_used)}s")
+                tenant.evict()
+                del self.active[key]
+
+
+tenants = TenantRegistry()
+
 # --- DB Connection Management ---
-def create_db_connection():
-    """Creates a new, fresh database connection and cursor."""
+def create_db_connection(tenant):
+    """Checks out a pooled database connection and cursor for the branch."""
     try:
-        
-        db = mysql.connector.connect(
-            host=DB_HOST, user=DB_USER, password=DB_PASSWORD, database=DB_DATABASE, autocommit=False
-        )
+        db = tenant.get_connection()
         # dictionary=True ensures we can access columns by name (e.g., s['name'])
         cursor = db.cursor(dictionary=True, buffered=True) 
         return db, cursor
     except mysql.connector.Error as err:
-        print(f"FATAL DATABASE ERROR: Cannot connect to MySQL: {err}")
+        print(f"FATAL DATABASE ERROR: Cannot connect to MySQL for branch {tenant.config['slug']}: {err}")
         # Re-raise error to be caught in the main handler
         raise ConnectionRefusedError(f"Database connection failed: {err}")
 
+# -------------------- Write-Behind Buffer -------------------- #
+def lock_file_exclusive(f):
+    """Takes a non-blocking exclusive lock on an open file. Returns False if another process holds it."""
+    try:
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        return True
+    except OSError:
+        return False
+
+
+class WriteBuffer:
+    """
+    Group-commits append-only rows that the customer doesn't need to see right away (feedback, audit rows).
+    Each row is written and fsynced to a local append log before append() returns, then a background thread
+    inserts queued rows per branch/table with multi-row INSERTs once WRITE_BUFFER_MAX_ROWS are waiting or every
+    WRITE_BUFFER_FLUSH_MS. Rows left in the log by a crash (process or host) are replayed on startup.
+    Delivery is at-least-once: a crash between the commit and the log rewrite replays that batch.
+    The buffer starts per process on first use, so each worker of a pre-fork server claims its own log.
+    """
+
+    def __init__(self, base_path):
+        self.base_path = base_path
+        self.reset()
+        if hasattr(os, 'register_at_fork'):
+            # A forked worker must not reuse the parent's log lock, queue or (missing) flusher thread
+            os.register_at_fork(after_in_child=self.reset)
+
+    def reset(self):
+        """Clears all per-process state; ensure_started() then claims a fresh log."""
+        self.pid = None
+        self.log_path = None
+        self.lock_file = None
+        self.pending = []  # Rows not yet committed: {'seq', 'branch', 'table', 'columns', 'values'}
+        self.next_seq = 1
+        self.retry_delay = 0
+        self.stopping = False
+        self.condition = threading.Condition()
+        self.start_lock = threading.Lock()
+        self.log_file = None
+        self.thread = None
+
+    def ensure_started(self):
+        """Starts the buffer in the current process if it isn't running here yet."""
+        if self.pid != os.getpid():
+            with self.start_lock:
+                if self.pid != os.getpid():
+                    self.start()
+
+    def start(self):
+        """Claims a log, replays rows left in it and starts the flusher thread."""
+        with self.condition:
+            self.log_path = self.claim_log()
+            self.pending = self.replay()
+            if self.pending:
+                print(f"WRITE BUFFER: Replaying {len(self.pending)} rows from {self.log_path}")
+                self.next_seq = self.pending[-1]['seq'] + 1
+            self.rewrite_log()
+
+        self.thread = threading.Thread(target=self.run, name="write-buffer", daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+        self.pid = os.getpid()
+
+    def append(self, branch_number, table, columns, values):
+        """Queues one row for insert. Values must be JSON-serializable. Raises OSError if the log can't be written."""
+        self.ensure_started()
+        with self.condition:
+            row = {
+                'seq': self.next_seq, 'branch': branch_number, 'table': table,
+                'columns': list(columns), 'values': list(values)
+            }
+            # On disk before returning, so the row survives a process or host crash
+            self.log_file.write(json.dumps(row) + "\n")
+            self.log_file.flush()
+            os.fsync(self.log_file.fileno())
+            self.next_seq += 1
+            self.pending.append(row)
+            if len(self.pending) == 1 or len(self.pending) >= WRITE_BUFFER_MAX_ROWS:
+                self.condition.notify()
+
+    def stop(self):
+        """Flushes whatever is queued and stops the flusher thread."""
+        with self.condition:
+            if self.stopping:
+                return
+            self.stopping = True
+            self.condition.notify()
+        if self.thread:
+            self.thread.join(timeout=10)
+
+    def claim_log(self):
+        """
+        Locks the first free log slot (write_buffer.log, write_buffer.1.log, ...) so worker processes never
+        share a log. A slot left behind by a crashed worker is claimed, and replayed, by the next one to start.
+        """
+        base, ext = os.path.splitext(self.base_path)
+        for slot in range(WRITE_BUFFER_MAX_LOGS):
+            log_path = self.base_path if slot == 0 else f"{base}.{slot}{ext}"
+            lock_file = open(f"{log_path}.lock", 'a+')
+            if lock_file_exclusive(lock_file):
+                # Kept open (and locked) for the life of the process
+                self.lock_file = lock_file
+                return log_path
+            lock_file.close()
+
+        print(f"FATAL ERROR: All {WRITE_BUFFER_MAX_LOGS} write buffer logs for {self.base_path} are locked by other processes.")
+        sys.exit(1)
+
+    def replay(self):
+        """Reads uncommitted rows from the log, skipping a torn last line or malformed rows."""
+        rows = []
+        if not os.path.exists(self.log_path):
+            return rows
+        with open(self.log_path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                except json.JSONDecodeError:
+                    print(f"WRITE BUFFER: Skipping unreadable log line: {line[:80]!r}")
+                    continue
+                if not isinstance(row, dict) or not {'seq', 'branch', 'table', 'columns', 'values'} <= row.keys():
+                    print(f"WRITE BUFFER: Skipping malformed log row: {line[:80]!r}")
+                    continue
+                rows.append(row)
+        return rows
+
+    def rewrite_log(self):
+        """
+        Replaces the log with just the pending rows. Called with self.condition held.
+        The current log stays open for appends unless the new one is fully written and in place.
+        """
+        temp_path = f"{self.log_path}.tmp"
+        new_log = open(temp_path, 'w', encoding='utf-8')
+        try:
+            for row in self.pending:
+                new_log.write(json.dumps(row) + "\n")
+            new_log.flush()
+            os.fsync(new_log.fileno())
+            os.replace(temp_path, self.log_path)
+        except OSError:
+            new_log.close()
+            raise
+
+        # The open handle follows the file through the rename, so it becomes the new append log
+        if self.log_file:
+            self.log_file.close()
+        self.log_file = new_log
+
+    def park(self, rows):
+        """Appends rows that can't be routed to a branch to a side file for manual recovery."""
+        with open(f"{self.log_path}.unrouted", 'a', encoding='utf-8') as f:
+            for row in rows:
+                f.write(json.dumps(row) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def run(self):
+        """Flusher thread: waits for a full batch or the flush interval, then commits."""
+        while True:
+            with self.condition:
+                while not self.pending and not self.stopping:
+                    self.condition.wait()
+
+                # After a failed flush, back off however many rows are queued.
+                # Otherwise flush as soon as a full batch is waiting, or when the interval is up.
+                deadline = time.monotonic() + (self.retry_delay or WRITE_BUFFER_FLUSH_MS / 1000)
+                while not self.stopping:
+                    if not self.retry_delay and len(self.pending) >= WRITE_BUFFER_MAX_ROWS:
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+
+                batch = self.pending
+                self.pending = []
+                stopping = self.stopping
+
+            try:
+                failed = self.flush(batch) if batch else []
+            except Exception as err:
+                # Never let the flusher thread die, or rows would pile up in the log forever
+                print(f"WRITE BUFFER ERROR: Flush failed ({type(err).__name__}: {err}). Retrying {len(batch)} rows later.")
+                failed = batch
+
+            with self.condition:
+                # Rows appended during the flush stay queued behind the ones that failed
+                self.pending = failed + self.pending
+                if failed:
+                    self.retry_delay = min(max(self.retry_delay * 2, 1), WRITE_BUFFER_MAX_RETRY_SECONDS)
+                else:
+                    self.retry_delay = 0
+                try:
+                    self.rewrite_log()
+                except OSError as err:
+                    print(f"WRITE BUFFER ERROR: Could not compact {self.log_path}: {err}")
+                if stopping:
+                    self.log_file.close()
+                    return
+
+    def flush(self, batch):
+        """Inserts a batch grouped by branch and table. Returns the rows that should be retried."""
+        groups = {}
+        for row in batch:
+            groups.setdefault((row['branch'], row['table'], tuple(row['columns'])), []).append(row)
+
+        failed = []
+        for (branch, table, columns), rows in groups.items():
+            # Exact match only: the webhook's fallback to the default branch would put these rows in the wrong database
+            config = tenants.configs.get(normalize_number(branch))
+            if config is None:
+                print(f"WRITE BUFFER: Branch {branch} is no longer configured. Parking {len(rows)} {table} rows in {self.log_path}.unrouted")
+                self.park(rows)
+                continue
+
+            tenant = tenants.checkout(config['twilio_number'])
+            try:
+                db = tenant.get_connection()
+                try:
+                    self.insert_rows(db, table, columns, rows)
+                finally:
+                    db.close()
+            except Exception as err:
+                print(f"WRITE BUFFER DB ERROR ({tenant.config['slug']}.{table}): {type(err).__name__}: {err}. Retrying {len(rows)} rows later.")
+                failed.extend(rows)
+            finally:
+                tenants.checkin(tenant)
+        return failed
+
+    def insert_rows(self, db, table, columns, rows):
+        """
+        Commits rows with one multi-row INSERT. If the data itself is rejected, falls back to
+        row-by-row inserts and drops the offending rows so they don't block the queue.
+        Connection errors are raised so the caller retries the whole group.
+        """
+        column_list = ", ".join(columns)
+        row_placeholders = "(" + ", ".join(["%s"] * len(columns)) + ")"
+        cursor = db.cursor()
+        try:
+            cursor.execute(
+                f"INSERT INTO {table} ({column_list}) VALUES " + ", ".join([row_placeholders] * len(rows)),
+                [value for row in rows for value in row['values']]
+            )
+            db.commit()
+        except (mysql.connector.errors.DataError, mysql.connector.errors.IntegrityError) as err:
+            db.rollback()
+            print(f"WRITE BUFFER: Batch insert into {table} rejected ({err}). Inserting rows one by one.")
+            for row in rows:
+                try:
+                    cursor.execute(f"INSERT INTO {table} ({column_list}) VALUES {row_placeholders}", row['values'])
+                    db.commit()
+                except (mysql.connector.errors.DataError, mysql.connector.errors.IntegrityError) as row_err:
+                    db.rollback()
+                    print(f"WRITE BUFFER: Dropping {table} row {row['values']}: {row_err}")
+        finally:
+            cursor.close()
+
+
+write_buffer = WriteBuffer(WRITE_BUFFER_LOG)
+
 # --- Session Functions ---
 def get_session(phone_number, cursor):
-    """Retrieves session data for a given phone number."""
+    """Retrieves session data for a given phone number and remembers it for save_session's change check."""
+    g.saved_session = None
     try:
         cursor.execute("SELECT * FROM sessions WHERE phone_number=%s", (phone_number,))
-        return cursor.fetchone()
+        session = cursor.fetchone()
+        if session:
+            try:
+                # Compare in our own encoding: a MySQL JSON column re-serializes the stored text
+                g.saved_session = (session['current_state'], encode_session(decode_session(session['temp_data'])))
+            except ValueError:
+                pass  # Corrupt data; the webhook resets the session
+        return session
     except mysql.connector.Error as err:
         print(f"SESSION DB ERROR (get_session): {err}")
         return None
 
 def save_session(phone_number, state, temp_data, db, cursor):
-    """Saves or updates session state and temporary data."""
+    """Saves or updates session state and temporary data. Skips the write when nothing changed."""
     try:
-        temp_json = json.dumps(temp_data)
+        temp_json = encode_session(temp_data)
+        if g.get('saved_session') == (state, temp_json):
+            return
         cursor.execute("""
             INSERT INTO sessions(phone_number, current_state, temp_data)
             VALUES (%s, %s, %s)
             ON DUPLICATE KEY UPDATE current_state=%s, temp_data=%s
         """, (phone_number, state, temp_json, state, temp_json))
         db.commit()
+        g.saved_session = (state, temp_json)
     except mysql.connector.Error as err:
         print(f"SESSION DB ERROR (save_session): {err}")
         db.rollback()
@@ -92,16 +605,14 @@ def get_main_menu_text():
         "💡 *Tip:* You can always reply 'menu' to return here."
     )
 
-def get_services_list(cursor):
-    """Fetches and formats a list of services. Includes detailed error checking."""
+def get_services_list(tenant, cursor):
+    """Fetches and formats a branch's list of services. Includes detailed error checking."""
     try:
         
-        final_query = "SELECT id, name, price, duration FROM services ORDER BY id ASC"
-        cursor.execute(final_query)
-        services = cursor.fetchall()
+        services = tenant.get_services(cursor)
         
         # Print number of rows fetched
-        print(f"DIAGNOSTIC: Successfully fetched {len(services)} services from the database.")
+        print(f"DIAGNOSTIC: {len(services)} services in the {tenant.config['slug']} catalog.")
 
         if not services:
             return "No services were returned by the database query. Please ensure your 'services' table has data (and correct column names).", [], []
@@ -136,8 +647,9 @@ def get_services_list(cursor):
         print(f"FATAL DB ERROR in get_services_list: {error_message}")
         return f"A critical database error occurred while listing services. Error: {e.msg} (Check table/columns).", [], []
 
-def get_available_dates():
-    """Calculates the next 7 available business days (excluding Sunday)."""
+def get_available_dates(tenant):
+    """Calculates the next 7 available business days (excluding the branch's closed day)."""
+    config = tenant.config
     available_dates = []
     current_date = datetime.now()
     count = 0
@@ -147,12 +659,12 @@ def get_available_dates():
     
     while count < 7:
         # Check if the current time is past today's operating hours
-        if len(available_dates) == 0 and start_time_check.hour >= SALON_END_HOUR:
+        if len(available_dates) == 0 and start_time_check.hour >= config['end_hour']:
             # If it is past 7 PM, start checking from the next day
             current_date += timedelta(days=1)
             
-        # Skip Sundays (day_name is 6)
-        if current_date.weekday() == EXCLUDED_WEEKDAY:
+        # Skip the closed day (Sunday is 6)
+        if current_date.weekday() == config['excluded_weekday']:
             current_date += timedelta(days=1)
             continue
             
@@ -166,46 +678,46 @@ def get_available_dates():
         
     return available_dates
 
-def get_available_slots(cursor, selected_date, service_id):
+def get_available_slots(tenant, cursor, selected_date, service_id):
     """
-    Generates available time slots for a given date, checking for existing bookings.
+    Generates available time slots for a given date, checking the branch's booked-slot index.
     Assumes a fixed 1-hour slot granularity for simplicity.
     """
+    config = tenant.config
     slots = []
     
     # Check if the date is today
     is_today = selected_date.date() == datetime.now().date()
     
-    # Calculate the effective start hour (next hour if today, otherwise SALON_START_HOUR)
-    start_hour = SALON_START_HOUR
+    # Calculate the effective start hour (next hour if today, otherwise the branch opening hour)
+    start_hour = config['start_hour']
     if is_today:
         now_hour = datetime.now().hour
         # Start from the next full hour, ensuring we don't start past closing
-        start_hour = max(SALON_START_HOUR, now_hour + 1)
+        start_hour = max(config['start_hour'], now_hour + 1)
         
     # Get the service duration (assuming in minutes, for future use)
-    cursor.execute("SELECT duration FROM services WHERE id=%s", (service_id,))
-    duration_str = cursor.fetchone()['duration'] if cursor.fetchone() else '60 mins'
+    service = tenant.find_service(cursor, service_id)
+    duration_str = service['duration'] if service else '60 mins'
     
     # Extract minutes from duration (e.g., '1 hr 15 mins' -> 75 minutes) - simplified to 60 min slots for now
     slot_duration_minutes = 60 
 
+    # All bookings for the day in one lookup instead of one query per slot
+    booked_times = tenant.get_booked_times(cursor, selected_date)
+
     # Generate potential slots
+    if start_hour >= config['end_hour']:
+        return slots
     current_time = selected_date.replace(hour=start_hour, minute=0, second=0, microsecond=0)
     
-    while current_time.hour < SALON_END_HOUR:
+    while current_time.hour < config['end_hour']:
         slot_end_time = current_time + timedelta(minutes=slot_duration_minutes)
         
         # Check if the slot ends before or at closing time
-        if slot_end_time.hour <= SALON_END_HOUR:
+        if slot_end_time.hour <= config['end_hour']:
             # 1. Check for existing bookings within this time slot
-           
-            cursor.execute("""
-                SELECT COUNT(*) as occupied FROM bookings
-                WHERE booking_time = %s
-            """, (current_time.strftime('%Y-%m-%d %H:%M:%S'),))
-            
-            if cursor.fetchone()['occupied'] == 0:
+            if current_time not in booked_times:
                 # Slot is available
                 slots.append({
                     'time_object': current_time,
@@ -228,26 +740,40 @@ def send_long_message(resp, message_parts):
 
 # -------------------- Flask App Webhook -------------------- #
 
+@app.before_request
+def start_write_buffer():
+    """Starts the write buffer (and replays its log) on a worker's first request."""
+    write_buffer.ensure_started()
+
 @app.route("/whatsapp", methods=['POST'])
 def whatsapp():
     """Handles incoming WhatsApp messages from Twilio."""
     
     incoming_msg = request.values.get('Body', '').strip()
     phone_number = request.values.get('From', '').replace('whatsapp:', '')
+    to_number = request.values.get('To', '')
 
     resp = MessagingResponse()
     
+    # Route to the branch that owns the receiving number
+    tenant = tenants.checkout(to_number)
+    if tenant is None:
+        print(f"ROUTING ERROR: No branch configured for number {to_number}")
+        resp.message("🛠️ This number is not linked to a Glow Haven branch yet. Please contact us directly.")
+        return str(resp)
+
     db = None
     cursor = None
 
     try:
         # Establish DB connection
-        db, cursor = create_db_connection()
+        db, cursor = create_db_connection(tenant)
     except ConnectionRefusedError:
-       
+        tenants.checkin(tenant)
         resp.message("🛠️ Our service is temporarily unavailable. Please try again in a few minutes.")
         return str(resp)
     except Exception as e:
+        tenants.checkin(tenant)
         print(f"UNEXPECTED ERROR ON STARTUP: {e}")
         resp.message("⚠️ An internal error occurred. Our team is looking into it.")
         return str(resp)
@@ -274,10 +800,10 @@ def whatsapp():
         state = session.get('current_state', 'menu')
         
         try:
-            temp_data_raw = session.get('temp_data')
-            temp_data = json.loads(temp_data_raw) if temp_data_raw else {}
-        except json.JSONDecodeError:
-            print(f"ERROR: JSONDecodeError for phone {phone_number}. Session cleared.")
+            temp_data = decode_session(session.get('temp_data'))
+        except ValueError as e:
+            # Also covers json.JSONDecodeError
+            print(f"ERROR: Invalid session data for phone {phone_number} ({e}). Session cleared.")
             temp_data = {}
             save_session(phone_number, 'menu', temp_data, db, cursor)
             resp.message("⚠️ We encountered an issue with your session data. Starting fresh. Please choose an option.")
@@ -297,7 +823,7 @@ def whatsapp():
                 
             elif user_input in ['2', 'book', 'schedule']:
                 # Option 2: Start Booking
-                message_status, services, service_lines = get_services_list(cursor)
+                message_status, services, service_lines = get_services_list(tenant, cursor)
                 
                 if not services:
                      resp.message(f"⚠️ {message_status}\n\nReturning to main menu.")
@@ -362,7 +888,7 @@ def whatsapp():
         # -------------------- Chat/Info Flow (Sub-Menu for Option 1) -------------------- #
         elif state == 'chat_info_menu':
             if user_input == '1':
-                message_status, services, service_lines = get_services_list(cursor)
+                message_status, services, service_lines = get_services_list(tenant, cursor)
                 
                 if not services:
                     resp.message(f"⚠️ {message_status}\n\nReply with **3** to go back or 'menu' to return to the main menu.")
@@ -387,12 +913,13 @@ def whatsapp():
                     send_long_message(resp, message_parts)
 
             elif user_input == '2':
+                config = tenant.config
                 resp.message(
-                    "📍 *Find Your Haven:*\n\n"
-                    "**Location:** 1st Floor, Valley Arcade Mall, Nairobi\n"
-                    "**Hours:** Mon-Sat, 9:00 AM - 7:00 PM | Sunday: Closed\n"
-                    "**Contact:** Call us at +254 712 345 678 or email info@glowhavenbeauty.co.ke\n\n"
-                    "**Instagram:** @glowhavenbeautylounge.\n\n"
+                    f"📍 *Find Your Haven ({config['name']}):*\n\n"
+                    f"**Location:** {config['location']}\n"
+                    f"**Hours:** {get_hours_text(config)}\n"
+                    f"**Contact:** {config['contact']}\n\n"
+                    f"**Instagram:** {config['instagram']}.\n\n"
                     "Reply with **3** to go back or 'menu' to return to the main menu."
                 )
             elif user_input == '3':
@@ -406,8 +933,7 @@ def whatsapp():
         elif state == 'service_selection':
             if user_input.isdigit():
                 service_id = int(user_input)
-                cursor.execute("SELECT id, name, price, duration FROM services WHERE id=%s", (service_id,))
-                service = cursor.fetchone()
+                service = tenant.find_service(cursor, service_id)
 
                 if service:
                     temp_data['service_id'] = service_id
@@ -430,8 +956,11 @@ def whatsapp():
             temp_data['user_name'] = user_name
             
             # --- NEW STEP 3: DATE SELECTION ---
-            dates = get_available_dates()
-            temp_data['available_dates'] = [d['date_object'].strftime('%Y-%m-%d') for d in dates] # Store dates as strings
+            dates = get_available_dates(tenant)
+            # Store dates compactly as day offsets from the first date
+            date_base = dates[0]['date_object'].toordinal()
+            temp_data['date_base'] = date_base
+            temp_data['date_offsets'] = [d['date_object'].toordinal() - date_base for d in dates]
             
             date_list = "📅 *Next Available Dates:*\n\n"
             for i, d in enumerate(dates):
@@ -448,16 +977,16 @@ def whatsapp():
             if user_input.isdigit():
                 choice = int(user_input)
                 
-                available_dates_str = temp_data.get('available_dates', [])
+                date_offsets = temp_data.get('date_offsets', [])
                 
-                if 1 <= choice <= len(available_dates_str):
-                    selected_date_str = available_dates_str[choice - 1]
-                    selected_date = datetime.strptime(selected_date_str, '%Y-%m-%d')
+                if 1 <= choice <= len(date_offsets):
+                    selected_offset = date_offsets[choice - 1]
+                    selected_date = datetime.fromordinal(temp_data['date_base'] + selected_offset)
                     
                     service_id = temp_data['service_id']
                     
                     # Get available time slots for the chosen date and service
-                    slots = get_available_slots(cursor, selected_date, service_id)
+                    slots = get_available_slots(tenant, cursor, selected_date, service_id)
                     
                     if not slots:
                         
@@ -468,18 +997,18 @@ def whatsapp():
                         save_session(phone_number, 'menu', {}, db, cursor)
                         return str(resp)
                     
-                    temp_data['selected_date'] = selected_date_str
-                    # Store slots in a dictionary for easy mapping (A -> time_object)
-                    slot_map = {}
+                    temp_data['selected_date'] = selected_offset
+                    # Store slot start times as minutes after midnight; the letter is the list index (A -> 0)
+                    slot_minutes = []
                     slot_list_msg = f"⏱️ *Available Slots for {day_name[selected_date.weekday()]}, {selected_date.strftime('%b %d')}:*\n\n"
                     
                     # Use ASCII letters (A, B, C...) for time slot choices
                     for i, slot in enumerate(slots):
                         slot_key = chr(ord('A') + i)
-                        slot_map[slot_key] = slot['time_object'].strftime('%Y-%m-%d %H:%M')
+                        slot_minutes.append(slot['time_object'].hour * 60 + slot['time_object'].minute)
                         slot_list_msg += f"*{slot_key}*. {slot['label']}\n"
                         
-                    temp_data['available_slots_map'] = slot_map
+                    temp_data['slot_minutes'] = slot_minutes
                     
                     slot_list_msg += "\n➡️ Please reply with the **letter** of the time slot you want."
                     
@@ -495,10 +1024,13 @@ def whatsapp():
         # -------------------- Booking Flow: Step 4 (Slot Selection & Confirmation) -------------------- #
         elif state == 'booking_slot_selection':
             user_choice_key = user_input.upper()
-            slot_map = temp_data.get('available_slots_map', {})
+            slot_minutes = temp_data.get('slot_minutes', [])
+            slot_index = ord(user_choice_key) - ord('A') if len(user_choice_key) == 1 else -1
             
-            if user_choice_key in slot_map:
-                booking_time_str = slot_map[user_choice_key]
+            if 0 <= slot_index < len(slot_minutes):
+                selected_date = datetime.fromordinal(temp_data['date_base'] + temp_data['selected_date'])
+                booking_time = selected_date + timedelta(minutes=slot_minutes[slot_index])
+                booking_time_str = booking_time.strftime('%Y-%m-%d %H:%M')
                 
                 # --- Final Booking Insert ---
                 service_id = temp_data['service_id']
@@ -510,13 +1042,26 @@ def whatsapp():
                         (user_name, phone_number, service_id, booking_time_str)
                     )
                     db.commit()
+                    tenant.mark_booked(booking_time)
                     resp.message(
                         f"🎉 *Booking Confirmed!* 🎉\n"
                         f"**Service:** {temp_data['service_name']}\n"
-                        f"**Time:** {datetime.strptime(booking_time_str, '%Y-%m-%d %H:%M').strftime('%A, %B %d at %I:%M %p')}\n"
+                        f"**Time:** {booking_time.strftime('%A, %B %d at %I:%M %p')}\n"
                         f"**Client:** {user_name}\n\n"
                         "We can't wait to pamper you! You can now send a payment (Option 3) or type 'menu'."
                     )
+                except mysql.connector.IntegrityError as e:
+                    db.rollback()
+                    if e.errno != errorcode.ER_DUP_ENTRY:
+                        print(f"DB Error on booking insert: {e}")
+                        resp.message("⚠️ A database error prevented the booking. Please try again.")
+                    else:
+                        # UNIQUE (booking_time): another worker booked this slot after our slot index was loaded
+                        tenant.mark_booked(booking_time)
+                        resp.message(
+                            f"😔 Sorry, the {booking_time.strftime('%I:%M %p').lstrip('0')} slot was just taken by another client.\n"
+                            "Please choose Option 2 to pick another time."
+                        )
                 except mysql.connector.Error as e:
                     print(f"DB Error on booking insert: {e}")
                     resp.message("⚠️ A database error prevented the booking. Please try again.")
@@ -653,22 +1198,22 @@ def whatsapp():
             rating = temp_data.get('review_rating')
             service_name = temp_data.get('review_service_name', 'service')
             
-            comment_to_save = comments if comments else None
+            # 'message' is NOT NULL in the feedback table, so store an empty comment as ''
+            comment_to_save = comments if comments else ''
 
             try:
-                cursor.execute("""
-                    INSERT INTO feedback (booking_id, rating, comments) 
-                    VALUES (%s, %s, %s)
-                """, (booking_id, rating, comment_to_save))
-                db.commit()
+                # Group-committed in the background; the customer doesn't need to wait for the insert
+                write_buffer.append(
+                    tenant.config['twilio_number'], 'feedback',
+                    ('booking_id', 'rating', 'message'), (booking_id, rating, comment_to_save)
+                )
                 resp.message(
                     f"💖 Feedback Received for the {service_name}!\n"
                     f"Your rating ({rating}/5) helps us improve. Thank you for choosing Glow Haven!"
                 )
-            except mysql.connector.Error as e:
-                print(f"DB Error on feedback insert: {e}")
-                db.rollback() 
-                resp.message("⚠️ A database error occurred. Your feedback could not be saved. Please try again.")
+            except OSError as e:
+                print(f"Write buffer error on feedback: {e}")
+                resp.message("⚠️ An error occurred. Your feedback could not be saved. Please try again.")
             except Exception as e:
                 print(f"General Error during feedback: {e}")
                 resp.message("⚠️ An unexpected error occurred. Please try again.")
@@ -691,11 +1236,17 @@ def whatsapp():
         resp.message("⚠️ A serious internal error occurred. Please wait a moment and try sending 'menu' again.")
         return str(resp)
     finally:
-        # Close the connection
-        if db and db.is_connected():
-            db.close()
+        # Return the connection to the branch pool (the pool reconnects broken ones on checkout)
+        if db:
+            try:
+                db.close()
+            except mysql.connector.Error as err:
+                print(f"DB ERROR returning connection to pool: {err}")
+        tenants.checkin(tenant)
 
 # -------------------- Run Flask -------------------- #
 if __name__ == "__main__":
-    print(f"Starting Glow Haven Bot. DB: {DB_DATABASE}@{DB_HOST}")
+    write_buffer.ensure_started()
+    for config in tenants.configs.values():
+        print(f"Starting Glow Haven Bot branch '{config['slug']}' on {config['twilio_number']}. DB: {config['db_database']}@{config['db_host']}")
     app.run(host='0.0.0.0', port=5000, debug=True, use_reloader=False)
@@ -0,0 +1,57 @@
+# -------------------- Session Codec Benchmark -------------------- #
+# Compares payload size and encode/decode time of the compact session codec against the
+# original free-form json.dumps(temp_data) format. Run with: python bench_session_codec.py
+import json
+import timeit
+from datetime import datetime, timedelta
+
+from session_codec import encode_session, decode_session
+
+RUNS = 20000
+REPEATS = 7
+
+
+def legacy_payload():
+    """temp_data as the original format stored it at the slot selection step (the largest payload)."""
+    start = datetime(2025, 11, 3)
+    dates = [start + timedelta(days=i) for i in range(8) if (start + timedelta(days=i)).weekday() != 6]
+    selected = dates[2]
+    return {
+        'service_id': 12,
+        'service_name': 'Classic Manicure & Gel Polish',
+        'user_name': 'Wanjiru Kamau',
+        'available_dates': [d.strftime('%Y-%m-%d') for d in dates],
+        'selected_date': selected.strftime('%Y-%m-%d'),
+        'available_slots_map': {
+            chr(ord('A') + i): selected.replace(hour=hour).strftime('%Y-%m-%d %H:%M')
+            for i, hour in enumerate(range(9, 19))
+        },
+    }
+
+
+def time_per_call(statement):
+    """Returns the time of one call in microseconds, taking the best of REPEATS runs to filter out noise."""
+    return min(timeit.repeat(statement, number=RUNS, repeat=REPEATS)) / RUNS * 1e6
+
+
+def main():
+    legacy = legacy_payload()
+    legacy_json = json.dumps(legacy)
+    compact = decode_session(legacy_json)  # Upgrades to the compact fields
+    compact_json = encode_session(compact)
+
+    rows = [
+        ("legacy json.dumps", len(legacy_json.encode('utf-8')),
+         time_per_call(lambda: json.dumps(legacy)), time_per_call(lambda: json.loads(legacy_json))),
+        ("compact v1", len(compact_json.encode('utf-8')),
+         time_per_call(lambda: encode_session(compact)), time_per_call(lambda: decode_session(compact_json))),
+    ]
+
+    print(f"{'format':<20}{'bytes':>8}{'encode us':>12}{'decode us':>12}")
+    for name, size, encode_us, decode_us in rows:
+        print(f"{name:<20}{size:>8}{encode_us:>12.2f}{decode_us:>12.2f}")
+    print(f"\nCompact payload: {compact_json}")
+
+
+if __name__ == "__main__":
+    main()
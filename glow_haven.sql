@@ -52,6 +52,7 @@ CREATE TABLE IF NOT EXISTS bookings (
     booking_time DATETIME NOT NULL,
     deposit_paid DECIMAL(10, 2) DEFAULT 0.00,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE KEY booking_time (booking_time),
     FOREIGN KEY (service_id) REFERENCES services(id)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 
@@ -145,6 +145,7 @@ CREATE TABLE `sessions` (
 --
 ALTER TABLE `bookings`
   ADD PRIMARY KEY (`id`),
+  ADD UNIQUE KEY `booking_time` (`booking_time`),
   ADD KEY `service_id` (`service_id`);
 
 --
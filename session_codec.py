@@ -0,0 +1,115 @@
+# -------------------- Session Payload Codec -------------------- #
+# Encodes the per-user session data (sessions.temp_data) as minimal, versioned JSON.
+# The column has a json_valid CHECK, so the wire format stays JSON, just with short keys,
+# no whitespace and compact values (date ordinals/offsets and slot minutes instead of formatted strings).
+import json
+from datetime import datetime
+
+SESSION_SCHEMA_VERSION = 1
+
+# In-memory field name -> (wire key, expected type); [int] means a list of ints
+SESSION_FIELDS = {
+    'service_id': ('s', int),
+    'service_name': ('sn', str),
+    'user_name': ('u', str),
+    'date_base': ('d', int),         # date.toordinal() of the first offered date
+    'date_offsets': ('do', [int]),   # Offered dates as day offsets from date_base
+    'selected_date': ('sd', int),    # Chosen date as a day offset from date_base
+    'slot_minutes': ('sm', [int]),   # Offered slots as minutes after midnight; slot 'A' is index 0
+    'booking_id': ('b', int),
+    'review_booking_id': ('rb', int),
+    'review_rating': ('r', int),
+    'review_service_name': ('rn', str),
+}
+# Wire key -> (field name, container type, item type for lists or None)
+SESSION_KEYS = {
+    key: (name, list, field_type[0]) if isinstance(field_type, list) else (name, field_type, None)
+    for name, (key, field_type) in SESSION_FIELDS.items()
+}
+WIRE_KEYS = {name: key for name, (key, field_type) in SESSION_FIELDS.items()}
+
+# Reused so json.dumps doesn't build a new encoder for the non-default separators on every call
+_encoder = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False)
+
+# Fields that kept the same name and meaning from the unversioned format
+LEGACY_FIELDS = ['service_id', 'service_name', 'user_name', 'booking_id',
+                 'review_booking_id', 'review_rating', 'review_service_name']
+
+
+def encode_session(temp_data):
+    """Encodes session data to compact JSON. Raises KeyError for a field missing from SESSION_FIELDS."""
+    payload = {WIRE_KEYS[name]: value for name, value in temp_data.items() if value is not None}
+    payload['v'] = SESSION_SCHEMA_VERSION
+    return _encoder.encode(payload)
+
+
+def decode_session(raw):
+    """Decodes a stored payload (current or unversioned format). Raises ValueError if it is corrupt."""
+    if not raw:
+        return {}
+
+    payload = json.loads(raw)
+    if not isinstance(payload, dict):
+        raise ValueError("Session payload is not an object")
+
+    version = payload.pop('v', None)
+    if version is None:
+        temp_data = upgrade_legacy_session(payload)
+        items = [(SESSION_FIELDS[name][0], value) for name, value in temp_data.items()]
+    elif version != SESSION_SCHEMA_VERSION:
+        raise ValueError(f"Unsupported session schema version: {version}")
+    else:
+        items = payload.items()
+
+    # Checked inline in one pass since this runs on every message.
+    # type() rather than isinstance() so bools aren't accepted as ints.
+    temp_data = {}
+    for key, value in items:
+        field = SESSION_KEYS.get(key)
+        if field is None:
+            continue
+        name, field_type, item_type = field
+        if type(value) is not field_type or item_type and not all(type(item) is item_type for item in value):
+            raise ValueError(f"Session field '{name}' has an invalid value: {value!r}")
+        temp_data[name] = value
+
+    check_dependencies(temp_data)
+    return temp_data
+
+
+def check_dependencies(temp_data):
+    """Raises ValueError if a field is present without the fields the booking steps read alongside it."""
+    if ('date_offsets' in temp_data or 'selected_date' in temp_data) and 'date_base' not in temp_data:
+        raise ValueError("Session has dates without date_base")
+    if 'slot_minutes' in temp_data and ('date_base' not in temp_data or 'selected_date' not in temp_data):
+        raise ValueError("Session has slots without a selected date")
+
+
+def upgrade_legacy_session(payload):
+    """
+    Converts an unversioned temp_data dict (formatted date/slot strings) to the current fields.
+    Raises ValueError if the legacy dates or slots can't be parsed.
+    """
+    try:
+        return _upgrade_legacy_fields(payload)
+    except (TypeError, AttributeError, KeyError) as err:
+        raise ValueError(f"Unreadable legacy session: {err}")
+
+
+def _upgrade_legacy_fields(payload):
+    temp_data = {name: payload[name] for name in LEGACY_FIELDS if name in payload}
+
+    available_dates = payload.get('available_dates')
+    if available_dates:
+        ordinals = [datetime.strptime(d, '%Y-%m-%d').toordinal() for d in available_dates]
+        temp_data['date_base'] = ordinals[0]
+        temp_data['date_offsets'] = [o - ordinals[0] for o in ordinals]
+        if payload.get('selected_date'):
+            temp_data['selected_date'] = datetime.strptime(payload['selected_date'], '%Y-%m-%d').toordinal() - ordinals[0]
+
+    slot_map = payload.get('available_slots_map')
+    if slot_map:
+        slot_times = [datetime.strptime(slot_map[key], '%Y-%m-%d %H:%M') for key in sorted(slot_map)]
+        temp_data['slot_minutes'] = [t.hour * 60 + t.minute for t in slot_times]
+
+    return temp_data